@@ -0,0 +1,198 @@
+import argparse
+import os
+import resource
+import selectors
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from chatClient import ChatClientSocketHandler
+
+SETTLE_TIME = 2.0
+TARGET_USERS = 50_000
+# A thread per connection does not get near TARGET_USERS, so the threaded
+# server is only measured up to this many by default.
+THREADED_USERS = 1000
+PROBES = 3
+PROBE_TIMEOUT = 600.0
+# A probe stops waiting for missing users once its list has not changed
+# for this long, e.g. because the server dropped some of them.
+QUIET_TIME = 10.0
+# Connections per loopback source address, one address only has about
+# 28k ephemeral ports to connect from.
+PORTS_PER_ADDRESS = 20_000
+# Idle clients read in batches, one recv per interval rather than per join.
+DRAIN_INTERVAL = 0.5
+
+
+def rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("VmRSS not reported")
+
+
+def start_server(low_memory: bool, history_dir: str
+                 ) -> tuple[subprocess.Popen, int]:
+    env = dict(os.environ, CHAT_LOW_MEMORY="1" if low_memory else "0",
+               CHAT_HISTORY_DIR=history_dir)
+    server = subprocess.Popen(
+        [sys.executable, "-u", "chatServer.py"], env=env,
+        stdout=subprocess.PIPE, text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    line = server.stdout.readline()
+    port = int(line.rsplit(":", 1)[-1])
+
+    # The server logs every connection, keep the pipe drained.
+    threading.Thread(target=server.stdout.read, daemon=True).start()
+    return server, port
+
+
+def wait_for_settle(pid: int) -> int:
+    previous = rss_bytes(pid)
+    while True:
+        time.sleep(SETTLE_TIME)
+        current = rss_bytes(pid)
+        if current <= previous:
+            return current
+        previous = current
+
+
+def drain(selector: selectors.BaseSelector, running: threading.Event
+          ) -> None:
+    # Idle users still receive join notices, so read and discard them to
+    # keep the server from blocking on full socket buffers.
+    while running.is_set():
+        if not selector.get_map():
+            time.sleep(0.1)
+            continue
+        for key, _ in selector.select(timeout=0.1):
+            try:
+                key.fileobj.recv(1024 * 1024)
+            except OSError:
+                pass
+        time.sleep(DRAIN_INTERVAL)
+
+
+def probe_connect(port: int, username: str, expected: int
+                  ) -> tuple[float, int]:
+    """
+    Logs in one more user and waits until it has heard of the expected
+    number of other users, or until its list stops growing. Returns how
+    long the list took to arrive and how many users it held.
+    """
+    changed = threading.Condition()
+    seen = 0
+    updated_at = None
+
+    def on_users(usernames: list[str], joined: bool) -> None:
+        nonlocal seen, updated_at
+        with changed:
+            seen += len(usernames) if joined else -len(usernames)
+            updated_at = time.perf_counter()
+            changed.notify()
+
+    client = ChatClientSocketHandler(lambda message: None, on_users)
+    start = time.perf_counter()
+    client.connect("127.0.0.1", port)
+    client.send_message(username)
+    try:
+        with changed:
+            if not changed.wait_for(lambda: updated_at is not None,
+                                    PROBE_TIMEOUT):
+                raise RuntimeError(f"{username} got no user list within "
+                                   f"{PROBE_TIMEOUT}s")
+            while seen < expected and changed.wait(QUIET_TIME):
+                pass
+            return updated_at - start, seen
+    finally:
+        client.close()
+
+
+def raise_fd_limit(count: int) -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = count + 100
+    if soft < needed:
+        if hard != resource.RLIM_INFINITY and hard < needed:
+            raise RuntimeError(f"{count} connections need {needed} file "
+                               f"descriptors, the hard limit is {hard}")
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+
+
+def bench_idle(count: int, low_memory: bool) -> None:
+    history_dir = tempfile.TemporaryDirectory()
+    server, port = start_server(low_memory, history_dir.name)
+    selector = selectors.DefaultSelector()
+    running = threading.Event()
+    running.set()
+    drainer = threading.Thread(target=drain, args=(selector, running),
+                               daemon=True)
+    drainer.start()
+    clients = []
+    try:
+        baseline = wait_for_settle(server.pid)
+        start = time.perf_counter()
+        for i in range(count):
+            source = f"127.0.0.{2 + i // PORTS_PER_ADDRESS}"
+            client = socket.create_connection(("127.0.0.1", port),
+                                              source_address=(source, 0))
+            client.sendall(f"user{i}\n".encode())
+            selector.register(client, selectors.EVENT_READ)
+            clients.append(client)
+        # The first probe only has its full list once every user above has
+        # been logged in, so this covers the whole ramp.
+        probe_start = time.perf_counter()
+        latency, logged_in = probe_connect(port, "probe", count)
+        ramp = probe_start + latency - start
+        loaded = wait_for_settle(server.pid)
+        probes = [probe_connect(port, f"probe{i}", count)
+                  for i in range(PROBES)]
+        latencies = [latency for latency, _ in probes]
+    finally:
+        running.clear()
+        drainer.join()
+        for client in clients:
+            client.close()
+        selector.close()
+        server.terminate()
+        server.wait()
+        history_dir.cleanup()
+
+    per_connection = (loaded - baseline) / count
+    print(f"low_memory={low_memory} connections={count}")
+    print(f"  baseline RSS:       {baseline / 2**20:10.1f} MiB")
+    print(f"  loaded RSS:         {loaded / 2**20:10.1f} MiB")
+    print(f"  per idle connection:{per_connection / 1024:10.1f} KiB")
+    if count < TARGET_USERS:
+        print(f"  projected {TARGET_USERS} users: "
+              f"{per_connection * TARGET_USERS / 2**20:.1f} MiB")
+    print(f"  users logged in:    {logged_in:10d} of {count}")
+    print(f"  time to log in all: {ramp:10.2f} s")
+    print(f"  connect latency:    {statistics.mean(latencies):10.3f} s mean, "
+          f"{max(latencies):.3f} s max")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measures the memory and login cost of idle users.")
+    parser.add_argument("count", type=int, nargs="?", default=TARGET_USERS,
+                        help="idle users for the low-memory server")
+    parser.add_argument("--threaded", type=int, default=THREADED_USERS,
+                        help="most idle users for the threaded server, "
+                             "0 skips it")
+    args = parser.parse_args()
+
+    threaded = min(args.count, args.threaded)
+    raise_fd_limit(max(args.count, threaded))
+    if threaded > 0:
+        bench_idle(threaded, low_memory=False)
+    bench_idle(args.count, low_memory=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,14 @@
 import socket
 import threading
-from typing import Callable
-from chatMessage import HEADER_LENGTH, MessageMeta, MessageKeys
+from typing import BinaryIO, Callable
+from chatMessage import (ATTACH_COMMAND, FRAME_HEADER, HEADER_LENGTH,
+                         MessageMeta, MessageKeys)
+from chatProfile import profiler
+import base64
 import curses
+import io
+import itertools
+import os
 import time
 import json
 import signal
@@ -152,6 +158,7 @@ class ChatClientDisplay:
         self._input_box.refresh()
         return self.MESSAGE_IN, message
 
+    @profiler.timed
     def update_messages(self, messages: list[str]) -> None:
         curses.curs_set(0)
 
@@ -195,7 +202,26 @@ class ChatClientDisplay:
         self.update_users(users)
 
 
+class IncomingTransfer:
+    __slots__ = ("sender", "name", "total", "received", "file", "path")
+
+    def __init__(self, sender: str, name: str, total: int, file: BinaryIO,
+                 path: str | None) -> None:
+        self.sender: str = sender
+        self.name: str = name
+        self.total: int = total
+        self.received: int = 0
+        self.file: BinaryIO = file
+        self.path: str | None = path
+
+
 class ChatClientSocketHandler:
+    DOWNLOAD_DIR = "downloads"
+    # Pastes up to this size are assembled in memory and shown inline,
+    # anything larger is written to DOWNLOAD_DIR.
+    INLINE_TEXT_BYTES = 64 * 1024
+    UPLOAD_READ_BYTES = 4096
+
     def __init__(self, message_callback: Callable[[str], None],
                  user_callback: Callable[[list[str], bool], None]) -> None:
         self._host: str | None = None
@@ -204,6 +230,11 @@ class ChatClientSocketHandler:
         self._user_callback: Callable[[list[str], bool], None] = user_callback
         self._socket = None
         self._running: bool = False
+        self._send_lock = threading.Lock()
+        self._transfers: dict[int, IncomingTransfer] = {}
+        # close() runs on another thread than the receive thread, which
+        # adds and removes transfers.
+        self._transfers_lock = threading.Lock()
 
     def connect(self, host: str, port: int) -> None:
         if self._running:
@@ -245,57 +276,198 @@ class ChatClientSocketHandler:
             value = f"{', '.join(usernames)} have left the chat."
             self._message_callback(value)
             self._user_callback(usernames, False)
+        elif meta == MessageMeta.STREAM.value:
+            self.handle_stream(message)
+        elif meta == MessageMeta.SEARCH_RESULTS.value:
+            results = message[MessageKeys.RESULTS.value]
+            total = message[MessageKeys.TOTAL.value]
+            more = "+" if message[MessageKeys.MORE.value] else ""
+            page = message[MessageKeys.PAGE.value]
+            self._message_callback(f"Search: {total}{more} results, showing "
+                                   f"page {page + 1}.")
+            for result in results:
+                sent = time.strftime("%Y-%m-%d %H:%M", time.localtime(
+                    result[MessageKeys.TIME.value]))
+                self._message_callback(
+                    f"[{sent}] {result[MessageKeys.SENDER.value]}: "
+                    f"{result[MessageKeys.CONTENT.value]}")
+
+    def handle_stream(self, message: dict) -> None:
+        transfer_id = message[MessageKeys.TRANSFER_ID.value]
+        offset = message[MessageKeys.OFFSET.value]
+        transfer = self._transfers.get(transfer_id)
+
+        if transfer is None:
+            # Joined part way through, the rest of this transfer is useless.
+            if offset != 0:
+                return
+            transfer = self.start_transfer(message)
+            with self._transfers_lock:
+                if not self._running:
+                    # close() has already closed every other download.
+                    transfer.file.close()
+                    return
+                self._transfers[transfer_id] = transfer
+
+        data = base64.b64decode(message[MessageKeys.DATA.value])
+        if transfer.file.tell() != offset:
+            transfer.file.seek(offset)
+        transfer.file.write(data)
+        transfer.received += len(data)
+
+        if transfer.received >= transfer.total:
+            with self._transfers_lock:
+                self._transfers.pop(transfer_id, None)
+            self.finish_transfer(transfer)
+
+    def start_transfer(self, message: dict) -> IncomingTransfer:
+        sender = message[MessageKeys.SENDER.value]
+        total = message[MessageKeys.TOTAL.value]
+        name = os.path.basename(message.get(MessageKeys.NAME.value, ""))
+
+        if not name and total <= self.INLINE_TEXT_BYTES:
+            return IncomingTransfer(sender, name, total, io.BytesIO(), None)
+
+        file, path = self.open_download(name or "paste.txt")
+        self._message_callback(f"{sender} is sending {name or 'a paste'} "
+                               f"({total} bytes).")
+        return IncomingTransfer(sender, name, total, file, path)
+
+    def open_download(self, name: str) -> tuple[BinaryIO, str]:
+        """
+        Creates a new file for name in DOWNLOAD_DIR, numbering it if the
+        name is taken. Transfer ids restart with the server, so they
+        cannot keep downloads apart.
+        """
+        os.makedirs(self.DOWNLOAD_DIR, exist_ok=True)
+        stem, extension = os.path.splitext(name)
+        path = os.path.join(self.DOWNLOAD_DIR, name)
+        for copy in itertools.count(1):
+            try:
+                return open(path, "xb"), path
+            except FileExistsError:
+                path = os.path.join(self.DOWNLOAD_DIR,
+                                    f"{stem}-{copy}{extension}")
+
+    def finish_transfer(self, transfer: IncomingTransfer) -> None:
+        if transfer.path is None:
+            content = transfer.file.getvalue().decode(errors="replace")
+            self._message_callback(f"{transfer.sender}: {content}")
+        else:
+            self._message_callback(f"Saved {transfer.name or 'paste'} from "
+                                   f"{transfer.sender} to {transfer.path}.")
+        transfer.file.close()
 
     def receive_message(self) -> None:
-        data_chunks = []
-        expected_chunks = None
+        # Chunks of different messages may interleave, so each message is
+        # assembled in its own buffer.
+        data_chunks: dict[int, list[tuple[int, bytes]]] = {}
         while self._running:
             try:
-                chunk = self._socket.recv(1024)
-                if not chunk:
+                frame = self.receive_frame()
+                if frame is None:
                     break
 
-                header = chunk[:HEADER_LENGTH].decode().strip()
-                body = chunk[HEADER_LENGTH:]
-
-                index, total = map(int, header.split("/"))
+                message_id, index, total, body = frame
 
-                if expected_chunks is None:
-                    expected_chunks = total
+                if total == 1:
+                    self.handle_message(body.decode())
+                    continue
 
-                data_chunks.append((index, body))
+                chunks = data_chunks.setdefault(message_id, [])
+                chunks.append((index, body))
 
-                if len(data_chunks) == expected_chunks:
-                    data_chunks.sort()
-                    full_data = b"".join(chunk for _, chunk in data_chunks)
+                if len(chunks) == total:
+                    del data_chunks[message_id]
+                    chunks.sort()
+                    full_data = b"".join(chunk for _, chunk in chunks)
                     message = full_data.decode()
 
                     self.handle_message(message)
 
-                    data_chunks.clear()
-                    expected_chunks = None
-
             except Exception as err:
+                # close() makes the pending recv fail, that is not an error.
+                if self._running:
+                    print(f"Error receiving message: {err}")
                 self._running = False
-                print(f"Error receiving message: {err}")
+
+    def receive_frame(self) -> tuple[int, int, int, bytes] | None:
+        header = self.receive_exactly(HEADER_LENGTH)
+        if header is None:
+            return None
+        length, message_id, index, total = FRAME_HEADER.unpack(header)
+        body = self.receive_exactly(length)
+        if body is None:
+            return None
+        return message_id, index, total, body
+
+    def receive_exactly(self, size: int) -> bytes | None:
+        data = b""
+        while len(data) < size:
+            piece = self._socket.recv(size - len(data))
+            if not piece:
+                return None
+            data += piece
+        return data
 
     def send_message(self, message: str) -> None:
         if not self._running:
             raise RuntimeError("Socket is not running")
 
         try:
-            self._socket.sendall(message.encode())
+            # The server reads up to a newline, so one message is one line.
+            line = message.replace("\n", " ") + "\n"
+            with self._send_lock:
+                self._socket.sendall(line.encode())
         except Exception as err:
             print(f"Error sending message: {err}")
 
+    def send_stream(self, source: BinaryIO, total: int, name: str = ""
+                    ) -> None:
+        """
+        Uploads total bytes of source as an attachment, or as a text paste
+        when no name is given. The socket is held until the upload is done,
+        since the server reads the raw bytes straight after the header.
+        """
+        if not self._running:
+            raise RuntimeError("Socket is not running")
+
+        header = f"{ATTACH_COMMAND} {total} {name}".rstrip() + "\n"
+        try:
+            with self._send_lock:
+                self._socket.sendall(header.encode())
+                remaining = total
+                while remaining > 0:
+                    piece = source.read(min(self.UPLOAD_READ_BYTES,
+                                            remaining))
+                    if not piece:
+                        raise RuntimeError("Attachment ended early")
+                    self._socket.sendall(piece)
+                    remaining -= len(piece)
+        except Exception as err:
+            print(f"Error sending attachment: {err}")
+
     def close(self) -> None:
         self._running = False
+        try:
+            # Close alone neither wakes the receive thread nor tells the
+            # server, both happen on shutdown.
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self._socket.close()
+        with self._transfers_lock:
+            transfers, self._transfers = self._transfers, {}
+        for transfer in transfers.values():
+            transfer.file.close()
 
 
 class ChatClient:
     HOST = "127.0.0.1"
     MESSAGE_IN = "You: "
+    # Longer text is streamed as a paste rather than sent as one line, so
+    # it stays well under the server's line limit.
+    PASTE_STREAM_BYTES = 1024
 
     def __init__(self, stdscr: curses.window) -> None:
         self._buffer = 20
@@ -308,6 +480,7 @@ class ChatClient:
                                                        self.handle_user)
 
         signal.signal(signal.SIGWINCH, self.handle_resize)
+        profiler.install_signal("client", notify=self.add_message)
 
     def start(self) -> None:
         username, port = self._display.login_screen()
@@ -324,8 +497,23 @@ class ChatClient:
                 field, message = self._display.get_input()
                 if message.lower() == "/quit":
                     break
+                if message.lower() == "/profile":
+                    threading.Thread(target=profiler.toggle_and_notify,
+                                     args=(self.add_message,),
+                                     daemon=True).start()
+                    continue
+                if message.startswith(f"{ATTACH_COMMAND} "):
+                    path = message[len(ATTACH_COMMAND) + 1:].strip()
+                    threading.Thread(target=self.send_attachment,
+                                     args=(path,), daemon=True).start()
+                    continue
                 self._messages.append(f"{field}{message}")
-                self._socket_handler.send_message(message)
+                data = message.encode()
+                if len(data) > self.PASTE_STREAM_BYTES:
+                    self._socket_handler.send_stream(io.BytesIO(data),
+                                                     len(data))
+                else:
+                    self._socket_handler.send_message(message)
                 self._display.update_messages(self._messages)
                 curses.noecho()
                 curses.curs_set(0)
@@ -333,6 +521,18 @@ class ChatClient:
             self._socket_handler.close()
         curses.noecho()
 
+    def send_attachment(self, path: str) -> None:
+        try:
+            total = os.path.getsize(path)
+            with open(path, "rb") as file:
+                self.add_message(f"Sending {path} ({total} bytes).")
+                self._socket_handler.send_stream(file, total,
+                                                 os.path.basename(path))
+        except OSError as err:
+            self.add_message(f"Could not send {path}: {err}")
+            return
+        self.add_message(f"Sent {path}.")
+
     def add_message(self, message: str) -> None:
         self._messages.append(message)
         self._messages = self._messages[-self._history_length:]
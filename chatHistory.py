@@ -0,0 +1,320 @@
+import bisect
+import datetime
+import json
+import os
+import pickle
+import queue
+import re
+import threading
+import time
+from array import array
+from typing import Callable, Iterator
+from chatMessage import MessageKeys
+
+TERM_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> set[str]:
+    return set(TERM_PATTERN.findall(text.lower()))
+
+
+def parse_time(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+class SearchQuery:
+    __slots__ = ("terms", "sender", "after", "before", "page")
+
+    def __init__(self, terms: list[str], sender: str | None = None,
+                 after: float | None = None, before: float | None = None,
+                 page: int = 0) -> None:
+        self.terms: list[str] = terms
+        self.sender: str | None = sender
+        self.after: float | None = after
+        self.before: float | None = before
+        self.page: int = page
+
+    @classmethod
+    def parse(cls, text: str) -> "SearchQuery":
+        """
+        Parses "[from:<user>] [after:<time>] [before:<time>] [page:<n>]
+        terms...", where times are unix timestamps or ISO dates and pages
+        count from 1.
+        """
+        query = cls([])
+        for word in text.split():
+            key, _, value = word.partition(":")
+            if key == "from" and value:
+                query.sender = value
+            elif key == "after" and value:
+                query.after = parse_time(value)
+            elif key == "before" and value:
+                query.before = parse_time(value)
+            elif key == "page" and value:
+                query.page = max(int(value) - 1, 0)
+            else:
+                query.terms.extend(tokenize(word))
+        return query
+
+
+class MessageHistory:
+    """
+    Append-only log of SEND messages with an inverted index over content
+    terms and sender names. Messages are numbered in arrival order, so
+    every posting list is sorted and time ranges map to id ranges. New
+    messages are indexed on a background thread; add() only queues them.
+    Searches run on the same thread, so they never hold up the caller.
+    """
+    HISTORY_FILE = "history.jsonl"
+    INDEX_FILE = "history.idx"
+    # Saving rewrites the whole index, so it is done on a timer rather
+    # than per message. Anything unsaved is re-indexed from the log on load.
+    SAVE_INTERVAL: float = 60.0
+    PAGE_SIZE: int = 10
+    # Matches are counted up to this many, past it only "more" is known.
+    COUNT_LIMIT: int = 1000
+
+    def __init__(self, directory: str = "history") -> None:
+        self._directory: str = directory
+        self._history_path = os.path.join(directory, self.HISTORY_FILE)
+        self._index_path = os.path.join(directory, self.INDEX_FILE)
+        self._lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+
+        # Byte offset of each message in the history file, plus its time.
+        self._offsets: array = array("Q")
+        self._times: array = array("d")
+        self._terms: dict[str, array] = {}
+        self._senders: dict[str, array] = {}
+        self._indexed_bytes: int = 0
+        self._unsaved: int = 0
+        self._saved_at: float = time.monotonic()
+        self._closed: bool = False
+
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+        self._writer = open(self._history_path, "ab")
+        self._reader = open(self._history_path, "rb")
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def load(self) -> None:
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "rb") as file:
+                state = pickle.load(file)
+            self._offsets = state["offsets"]
+            self._times = state["times"]
+            self._terms = state["terms"]
+            self._senders = state["senders"]
+            self._indexed_bytes = state["indexed_bytes"]
+
+        size = (os.path.getsize(self._history_path)
+                if os.path.exists(self._history_path) else 0)
+        if self._indexed_bytes > size:
+            # The index was saved ahead of the log. The last message that
+            # starts in the log may be cut short, so it is forgotten too
+            # and read again below if it is whole.
+            keep = max(bisect.bisect_left(self._offsets, size) - 1, 0)
+            self._indexed_bytes = self._offsets[keep] if self._offsets else 0
+            self.forget(keep)
+
+        if not os.path.exists(self._history_path):
+            return
+
+        # Catch up on anything written after the index was last saved.
+        with open(self._history_path, "rb") as file:
+            file.seek(self._indexed_bytes)
+            offset = self._indexed_bytes
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Left by an older crash, skip it but keep the rest.
+                    offset += len(line)
+                    continue
+                self.index(offset, record[MessageKeys.TIME.value],
+                           record[MessageKeys.SENDER.value],
+                           record[MessageKeys.CONTENT.value])
+                offset += len(line)
+                self._unsaved += 1
+            self._indexed_bytes = offset
+
+        with open(self._history_path, "rb+") as file:
+            file.truncate(self._indexed_bytes)
+
+    def save(self) -> None:
+        with self._lock:
+            # The saved index must never point past what is on disk.
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            state = {
+                "offsets": self._offsets,
+                "times": self._times,
+                "terms": self._terms,
+                "senders": self._senders,
+                "indexed_bytes": self._indexed_bytes,
+            }
+            temp_path = f"{self._index_path}.tmp"
+            with open(temp_path, "wb") as file:
+                pickle.dump(state, file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self._index_path)
+            self._unsaved = 0
+            self._saved_at = time.monotonic()
+
+    def add(self, sender: str, content: str) -> None:
+        # Handler threads may still be finishing a message during shutdown.
+        if self._closed:
+            return
+        self._queue.put((time.time(), sender, content))
+
+    def run(self) -> None:
+        while True:
+            if (self._unsaved and time.monotonic() - self._saved_at
+                    >= self.SAVE_INTERVAL):
+                self.save()
+            try:
+                item = self._queue.get(timeout=self.SAVE_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is None:
+                return
+            if isinstance(item[0], SearchQuery):
+                self.answer(*item)
+                continue
+            timestamp, sender, content = item
+            if self._times:
+                timestamp = max(timestamp, self._times[-1])
+            line = json.dumps({
+                MessageKeys.TIME.value: timestamp,
+                MessageKeys.SENDER.value: sender,
+                MessageKeys.CONTENT.value: content,
+            }).encode() + b"\n"
+
+            with self._lock:
+                offset = self._writer.tell()
+                self._writer.write(line)
+                if self._queue.empty():
+                    self._writer.flush()
+                self.index(offset, timestamp, sender, content)
+                self._indexed_bytes = offset + len(line)
+                self._unsaved += 1
+
+    def forget(self, count: int) -> None:
+        """
+        Drops every message from id count onwards from the index.
+        """
+        del self._offsets[count:]
+        del self._times[count:]
+        for postings in (self._terms, self._senders):
+            for key in list(postings):
+                message_ids = postings[key]
+                del message_ids[bisect.bisect_left(message_ids, count):]
+                if not message_ids:
+                    del postings[key]
+
+    def index(self, offset: int, timestamp: float, sender: str,
+              content: str) -> None:
+        message_id = len(self._offsets)
+        self._offsets.append(offset)
+        self._times.append(timestamp)
+        self._senders.setdefault(sender, array("I")).append(message_id)
+        for term in tokenize(content):
+            self._terms.setdefault(term, array("I")).append(message_id)
+
+    def search(self, query: SearchQuery,
+               callback: Callable[[int, bool, list[dict]], None]) -> None:
+        """
+        Queues query behind any messages still being indexed. The indexer
+        thread later calls callback with the arguments find returns.
+        """
+        if self._closed:
+            return
+        self._queue.put((query, callback))
+
+    def answer(self, query: SearchQuery,
+               callback: Callable[[int, bool, list[dict]], None]) -> None:
+        try:
+            callback(*self.find(query))
+        except Exception as err:
+            # The indexer thread must outlive a failed reply.
+            print(f"Error answering search: {err}")
+
+    def find(self, query: SearchQuery) -> tuple[int, bool, list[dict]]:
+        """
+        Returns the number of matches up to COUNT_LIMIT, whether there are
+        more, and one page of them, newest first. Matches are walked from
+        the newest and the walk stops once both are known, so pages past
+        COUNT_LIMIT come back empty.
+        """
+        with self._lock:
+            low = 0
+            high = len(self._offsets)
+            if query.after is not None:
+                low = bisect.bisect_left(self._times, query.after)
+            if query.before is not None:
+                high = bisect.bisect_left(self._times, query.before)
+
+            postings = [self._terms.get(term, array("I"))
+                        for term in query.terms]
+            if query.sender is not None:
+                postings.append(self._senders.get(query.sender, array("I")))
+
+            start = query.page * self.PAGE_SIZE
+            page = []
+            total = 0
+            more = False
+            for message_id in self.newest_first(postings, low, high):
+                if total == self.COUNT_LIMIT:
+                    more = True
+                    break
+                if start <= total < start + self.PAGE_SIZE:
+                    page.append(message_id)
+                total += 1
+
+            self._writer.flush()
+            results = [self.read(message_id) for message_id in page]
+            return total, more, results
+
+    @staticmethod
+    def newest_first(postings: list[array], low: int, high: int
+                     ) -> Iterator[int]:
+        """
+        Yields the ids in [low, high) found in every posting list, newest
+        first. Candidates come from the shortest list; since they only go
+        down, each other list is searched below its last position.
+        """
+        if not postings:
+            yield from range(high - 1, low - 1, -1)
+            return
+
+        postings = sorted(postings, key=len)
+        smallest, others = postings[0], postings[1:]
+        bounds = [len(other) for other in others]
+        first = bisect.bisect_left(smallest, low)
+        for i in range(bisect.bisect_left(smallest, high) - 1, first - 1, -1):
+            message_id = smallest[i]
+            for j, other in enumerate(others):
+                bounds[j] = bisect.bisect_left(other, message_id, 0, bounds[j])
+                if bounds[j] == len(other) or other[bounds[j]] != message_id:
+                    break
+            else:
+                yield message_id
+
+    def read(self, message_id: int) -> dict:
+        self._reader.seek(self._offsets[message_id])
+        return json.loads(self._reader.readline())
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self.save()
+        self._writer.close()
+        self._reader.close()
@@ -1,8 +1,27 @@
 from enum import Enum
-from typing import Generator
+from itertools import count
+from typing import BinaryIO, Generator
+import base64
 import json
-
-HEADER_LENGTH = 16
+import struct
+from chatProfile import profiler
+
+# Every frame starts with its body length, message id, chunk index and
+# chunk count. The length lets readers split a stream that holds several
+# frames, so bodies are sent as is rather than padded. The id keeps the
+# chunks of messages that interleave apart.
+FRAME_HEADER = struct.Struct("!IIII")
+HEADER_LENGTH = FRAME_HEADER.size
+# Largest frame, longer messages are split into several chunks.
+FRAME_BYTES = 1024
+# Raw bytes per STREAM message. With ASCII names its base64 data and JSON
+# envelope fit in a single chunk. json.dumps escapes anything else to up
+# to 12 bytes a character, so a non-ASCII sender or file name can take a
+# second chunk, which is reassembled by message id like any other.
+STREAM_PIECE_BYTES = 512
+STREAM_NAME_LEN = 64
+ATTACH_COMMAND = "/attach"
+SEARCH_COMMAND = "/search"
 
 
 class MessageMeta(Enum):
@@ -11,6 +30,8 @@ class MessageMeta(Enum):
     LEAVE = 2
     BATCH_JOIN = 3
     BATCH_LEAVE = 4
+    STREAM = 5
+    SEARCH_RESULTS = 6
 
 
 class MessageKeys(Enum):
@@ -19,22 +40,33 @@ class MessageKeys(Enum):
     CONTENT = "content"
     USERNAME = "username"
     USERNAMES = "usernames"
+    TRANSFER_ID = "transfer_id"
+    OFFSET = "offset"
+    TOTAL = "total"
+    NAME = "name"
+    DATA = "data"
+    RESULTS = "results"
+    PAGE = "page"
+    MORE = "more"
+    TIME = "time"
 
 
 class MessageFactory:
     def __init__(self, message_bytes: int) -> None:
         self._message_bytes = message_bytes
+        self._message_ids = count()
 
+    @profiler.timed
     def create_chunks(self, data: dict) -> Generator[bytes, None, None]:
         json_data = json.dumps(data).encode()
-        total_chunks = ((len(json_data) + self._message_bytes - 1) //
-                        self._message_bytes)
+        body_bytes = self._message_bytes - HEADER_LENGTH
+        total_chunks = (len(json_data) + body_bytes - 1) // body_bytes
+        message_id = next(self._message_ids) & 0xFFFFFFFF
 
         for i in range(total_chunks):
-            chunk = json_data[
-                    i * self._message_bytes:(i + 1) * self._message_bytes]
-            header = f"{i+1}/{total_chunks}".encode().ljust(HEADER_LENGTH)
-            yield header + chunk
+            chunk = json_data[i * body_bytes:(i + 1) * body_bytes]
+            yield FRAME_HEADER.pack(len(chunk), message_id, i + 1,
+                                    total_chunks) + chunk
 
     def message(self, sender: str, message: str
                 ) -> Generator[bytes, None, None]:
@@ -75,6 +107,48 @@ class MessageFactory:
         }
         return self.create_chunks(data)
 
+    def stream(self, sender: str, transfer_id: int, source: BinaryIO,
+               total: int, name: str = "") -> Generator[bytes, None, None]:
+        """
+        Yields the chunks of one message per STREAM_PIECE_BYTES of source,
+        read lazily so the payload is never held in memory. The name is only
+        carried on the first message; an empty name marks a text paste.
+        """
+        offset = 0
+        while offset < total:
+            piece = source.read(min(STREAM_PIECE_BYTES, total - offset))
+            if not piece:
+                return
+            data = {
+                MessageKeys.META.value: MessageMeta.STREAM.value,
+                MessageKeys.SENDER.value: sender,
+                MessageKeys.TRANSFER_ID.value: transfer_id,
+                MessageKeys.OFFSET.value: offset,
+                MessageKeys.TOTAL.value: total,
+                MessageKeys.DATA.value: base64.b64encode(piece).decode(),
+            }
+            if offset == 0:
+                data[MessageKeys.NAME.value] = name[:STREAM_NAME_LEN]
+            yield from self.create_chunks(data)
+            offset += len(piece)
+
+    def search_results(self, results: list[dict], total: int, more: bool,
+                       page: int) -> Generator[bytes, None, None]:
+        data = {
+            MessageKeys.META.value: MessageMeta.SEARCH_RESULTS.value,
+            MessageKeys.RESULTS.value: results,
+            MessageKeys.TOTAL.value: total,
+            MessageKeys.MORE.value: more,
+            MessageKeys.PAGE.value: page,
+        }
+        return self.create_chunks(data)
+
+    def invalid_search(self, sender: str, query: str
+                       ) -> Generator[bytes, None, None]:
+        message = (f"\"{query}\" is an invalid search. Use [from:<user>] "
+                   f"[after:<time>] [before:<time>] [page:<n>] terms.")
+        return self.message(sender, message)
+
     def invalid_username(self, sender: str, username: str
                          ) -> Generator[bytes, None, None]:
         message = f"\"{username}\" is an invalid username."
@@ -95,3 +169,9 @@ class MessageFactory:
         message = (f"\"{username}\" has invalid characters. The following "
                    f"char is invalid \"{inv_char}\"")
         return self.message(sender, message)
+
+    def attachment_too_large(self, sender: str, total: int, max_bytes: int
+                             ) -> Generator[bytes, None, None]:
+        message = (f"Attachment of {total} bytes is too large. Maximum size "
+                   f"is {max_bytes} bytes.")
+        return self.message(sender, message)
@@ -0,0 +1,223 @@
+import collections
+import inspect
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from functools import wraps
+from typing import Callable
+
+
+class Profiler:
+    SAMPLE_INTERVAL: float = 0.02
+    PRUNE_PASSES: int = 50
+    # Every extra frame makes each traced allocation slower, one frame is
+    # enough to attribute allocations to a line.
+    TRACEMALLOC_FRAMES: int = 1
+    TOP_ALLOCATIONS: int = 25
+
+    def __init__(self, output_dir: str = "profiles") -> None:
+        self._output_dir: str = output_dir
+        self._name: str = "chat"
+        self._enabled: bool = False
+        self._lock = threading.Lock()
+        # Held for a whole enable or disable, so a second toggle (signal or
+        # /profile) waits for the first rather than running half way in.
+        self._toggle_lock = threading.RLock()
+        self._stop_sampling = threading.Event()
+        self._started: float = 0.0
+
+        # name -> [calls, total seconds, max seconds]
+        self._timings: dict[str, list] = {}
+        self._samples: collections.Counter = collections.Counter()
+        self._sampler: threading.Thread | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    def timed(self, func):
+        name = func.__qualname__
+
+        if inspect.isgeneratorfunction(func):
+            # Generators do their work lazily, so time each step rather than
+            # the call that only builds the generator.
+            @wraps(func)
+            def gen_wrapper(*args, **kwargs):
+                gen = func(*args, **kwargs)
+                if not self._enabled:
+                    yield from gen
+                    return
+                elapsed = 0.0
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        try:
+                            item = next(gen)
+                        finally:
+                            elapsed += time.perf_counter() - start
+                        yield item
+                except StopIteration:
+                    pass
+                finally:
+                    self._record(name, elapsed)
+            return gen_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self._enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._record(name, time.perf_counter() - start)
+        return wrapper
+
+    def _record(self, name: str, elapsed: float) -> None:
+        with self._lock:
+            stats = self._timings.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+    def _sample(self) -> None:
+        own_id = threading.get_ident()
+        labels: dict = {}
+        # thread id -> [top frame, instruction, stack, first pass parked]
+        parked: dict[int, list] = {}
+        passes = 0
+        while not self._stop_sampling.is_set():
+            passes += 1
+            frames = sys._current_frames()
+            frames.pop(own_id, None)
+            for thread_id, frame in frames.items():
+                entry = parked.get(thread_id)
+                if (entry is not None and entry[0] is frame
+                        and entry[1] == frame.f_lasti):
+                    # Still on the same instruction, e.g. blocked in recv or
+                    # select. Its samples are credited once it moves, so idle
+                    # threads cost a lookup rather than a stack walk.
+                    continue
+                if entry is not None:
+                    self._samples[entry[2]] += passes - entry[3]
+
+                top = frame
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = (f"{os.path.basename(code.co_filename)}:"
+                                 f"{code.co_name}")
+                        labels[code] = label
+                    names.append(label)
+                    frame = frame.f_back
+                names.reverse()
+                parked[thread_id] = [top, top.f_lasti, ";".join(names), passes]
+
+            if passes % self.PRUNE_PASSES == 0:
+                for thread_id in list(parked):
+                    if thread_id not in frames:
+                        entry = parked.pop(thread_id)
+                        self._samples[entry[2]] += passes - entry[3]
+            del frames
+            self._stop_sampling.wait(self.SAMPLE_INTERVAL)
+
+        for entry in parked.values():
+            self._samples[entry[2]] += passes + 1 - entry[3]
+
+    def enable(self) -> None:
+        with self._toggle_lock:
+            if self._enabled:
+                return
+            with self._lock:
+                self._timings.clear()
+                self._samples.clear()
+            self._started = time.time()
+
+            tracemalloc.start(self.TRACEMALLOC_FRAMES)
+            self._stop_sampling.clear()
+            self._sampler = threading.Thread(target=self._sample,
+                                             daemon=True)
+            self._sampler.start()
+            # Only marked on once everything disable() stops is running.
+            self._enabled = True
+
+    def disable(self) -> str | None:
+        with self._toggle_lock:
+            if not self._enabled:
+                return None
+            self._enabled = False
+
+            self._stop_sampling.set()
+            self._sampler.join()
+            self._sampler = None
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            return self.dump(snapshot)
+
+    def toggle(self) -> str | None:
+        with self._toggle_lock:
+            if self._enabled:
+                return self.disable()
+            self.enable()
+            return None
+
+    def dump(self, snapshot: tracemalloc.Snapshot) -> str:
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self._started))
+        prefix = os.path.join(self._output_dir,
+                              f"{self._name}-{os.getpid()}-{stamp}")
+        os.makedirs(self._output_dir, exist_ok=True)
+
+        with self._lock:
+            timings = sorted(self._timings.items(),
+                             key=lambda item: item[1][1], reverse=True)
+            samples = self._samples.most_common()
+
+        with open(f"{prefix}.timings.txt", "w") as file:
+            file.write(f"{'function':<50} {'calls':>8} {'total ms':>12} "
+                       f"{'mean ms':>10} {'max ms':>10}\n")
+            for name, (calls, total, longest) in timings:
+                file.write(f"{name:<50} {calls:>8} {total * 1000:>12.3f} "
+                           f"{total * 1000 / calls:>10.3f} "
+                           f"{longest * 1000:>10.3f}\n")
+
+        # Collapsed stacks, can be fed straight into flamegraph tooling.
+        with open(f"{prefix}.samples.txt", "w") as file:
+            for stack, count in samples:
+                file.write(f"{stack} {count}\n")
+
+        snapshot.dump(f"{prefix}.tracemalloc")
+        with open(f"{prefix}.allocations.txt", "w") as file:
+            for stat in snapshot.statistics("lineno")[:self.TOP_ALLOCATIONS]:
+                file.write(f"{stat}\n")
+
+        return prefix
+
+    def install_signal(self, name: str, signum: int | None = None,
+                       notify: Callable[[str], None] = print) -> None:
+        self._name = name
+        if signum is None:
+            signum = getattr(signal, "SIGUSR1", None)
+        if signum is None:
+            return
+
+        def handler(*args) -> None:
+            # Dumping takes locks, so never do it inside the signal handler.
+            threading.Thread(target=self.toggle_and_notify, args=(notify,),
+                             daemon=True).start()
+
+        signal.signal(signum, handler)
+
+    def toggle_and_notify(self, notify: Callable[[str], None]) -> None:
+        prefix = self.toggle()
+        if prefix is None:
+            notify(f"Profiling enabled for {self._name}")
+        else:
+            notify(f"Profiling dumped to {prefix}.*")
+
+
+profiler = Profiler(os.environ.get("CHAT_PROFILE_DIR", "profiles"))
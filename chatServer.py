@@ -1,10 +1,20 @@
+import collections
+import itertools
+import os
+import select
+import selectors
 import socket
 import string
+import sys
+import tempfile
 import threading
 import time
-from functools import wraps
-from typing import Iterator
-from chatMessage import MessageFactory
+from functools import partial, wraps
+from typing import BinaryIO, Callable, Iterator
+from chatHistory import MessageHistory, SearchQuery
+from chatMessage import (ATTACH_COMMAND, FRAME_BYTES, SEARCH_COMMAND,
+                         MessageFactory)
+from chatProfile import profiler
 
 
 def thread_safe_method(func):
@@ -15,30 +25,196 @@ def thread_safe_method(func):
     return wrapper
 
 
+class ClientSession:
+    # Slotted so an idle connection costs a few pointers, not a __dict__.
+    __slots__ = ("socket", "username", "addr", "outbox", "queued",
+                 "send_lock", "inbox")
+
+    def __init__(self, socket: socket.socket, username: str | None,
+                 addr=None, send_lock=None) -> None:
+        self.socket: socket.socket = socket
+        self.username: str | None = username
+        self.addr = addr
+        # Threaded connections are written to by several threads at once.
+        # The low-memory server serialises writes on its outbox lock.
+        self.send_lock: threading.Lock | None = send_lock
+        # Frames the socket would not take yet. Only created once a send
+        # falls behind, so idle sessions carry no buffer at all.
+        self.outbox: collections.deque[bytes] | None = None
+        self.queued: int = 0
+        # The start of a message whose newline has not arrived yet, None
+        # between messages.
+        self.inbox: bytes | None = None
+
+
+class Upload:
+    __slots__ = ("transfer_id", "name", "total", "remaining", "file")
+
+    def __init__(self, transfer_id: int, name: str, total: int,
+                 file: BinaryIO | None) -> None:
+        self.transfer_id: int = transfer_id
+        self.name: str = name
+        self.total: int = total
+        self.remaining: int = total
+        # None when the upload is rejected and its bytes are discarded.
+        self.file: BinaryIO | None = file
+
+
+class Transfer:
+    __slots__ = ("recipients", "frames", "source", "stalled_since")
+
+    def __init__(self, recipients: list[socket.socket],
+                 frames: Iterator[bytes], source: BinaryIO) -> None:
+        self.recipients: list[socket.socket] = recipients
+        self.frames: Iterator[bytes] = frames
+        self.source: BinaryIO = source
+        self.stalled_since: float | None = None
+
+
+class TransferScheduler:
+    """
+    Sends STREAM frames one at a time, round-robin across transfers, so a
+    large attachment never holds up other transfers. Normal chat frames
+    bypass the scheduler and go out immediately between stream frames.
+    A transfer only sends its next frame once every recipient can take it
+    without blocking, otherwise it is skipped until the next round. Slow
+    readers therefore pace their transfers instead of being disconnected.
+    """
+    # Pause before the next round when no transfer could send anything.
+    STALL_WAIT: float = 0.05
+    # A recipient that takes nothing for this long is left out of the rest
+    # of that transfer, so one idle reader cannot hold it forever.
+    STALL_TIMEOUT: float = 30.0
+
+    def __init__(self,
+                 connected: Callable[[list[socket.socket]],
+                                     list[socket.socket]],
+                 writable: Callable[[list[socket.socket], int],
+                                    list[socket.socket]],
+                 send: Callable[[list[socket.socket], bytes], None]) -> None:
+        self._connected = connected
+        self._writable = writable
+        self._send = send
+        self._transfers: collections.deque[Transfer] = collections.deque()
+        self._condition = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._running: bool = False
+
+    def add(self, recipients: list[socket.socket], frames: Iterator[bytes],
+            source: BinaryIO) -> None:
+        with self._condition:
+            self._transfers.append(Transfer(recipients, frames, source))
+            if self._thread is None:
+                self._running = True
+                self._thread = threading.Thread(target=self.run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def run(self) -> None:
+        stalled = 0
+        while True:
+            with self._condition:
+                while self._running and not self._transfers:
+                    self._condition.wait()
+                if self._running and stalled >= len(self._transfers):
+                    # A whole round went by without sending anything.
+                    self._condition.wait(self.STALL_WAIT)
+                    stalled = 0
+                if not self._running:
+                    return
+                transfer = self._transfers.popleft()
+
+            if self.send_next(transfer):
+                stalled = 0
+            else:
+                stalled += 1
+
+            with self._condition:
+                if transfer.source.closed:
+                    continue
+                if self._running:
+                    self._transfers.append(transfer)
+                else:
+                    transfer.source.close()
+
+    def send_next(self, transfer: Transfer) -> bool:
+        """
+        Sends the transfer's next frame, closing its source once it is
+        done. Returns False if the transfer is stalled on a recipient.
+        """
+        recipients = self._connected(transfer.recipients)
+        ready = self._writable(recipients, FRAME_BYTES)
+        if len(ready) < len(recipients):
+            now = time.monotonic()
+            if transfer.stalled_since is None:
+                transfer.stalled_since = now
+            if now - transfer.stalled_since < self.STALL_TIMEOUT:
+                transfer.recipients = recipients
+                return False
+            recipients = ready
+        transfer.stalled_since = None
+        transfer.recipients = recipients
+
+        frame = next(transfer.frames, None) if recipients else None
+        if frame is None:
+            transfer.source.close()
+        else:
+            self._send(recipients, frame)
+        return True
+
+    def stop(self) -> None:
+        with self._condition:
+            self._running = False
+            for transfer in self._transfers:
+                transfer.source.close()
+            self._transfers.clear()
+            self._condition.notify_all()
+
+
 class Clients:
     def __init__(self):
-        self._clients: dict[socket.socket, str] = {}
+        self._clients: dict[socket.socket, ClientSession] = {}
+        self._usernames: set[str] = set()
         self._lock = threading.Lock()
 
     @thread_safe_method
-    def add_client(self, socket: socket.socket, username: str) -> None:
-        self._clients[socket] = username
+    def add_client(self, session: ClientSession) -> None:
+        self._clients[session.socket] = session
+        self._usernames.add(session.username)
 
     @thread_safe_method
     def remove_client(self, socket: socket.socket) -> None:
-        self._clients.pop(socket, None)
+        session = self._clients.pop(socket, None)
+        if session is not None:
+            self._usernames.discard(session.username)
 
     @thread_safe_method
     def get_clients(self) -> list[socket.socket]:
         return list(self._clients.keys())
 
     @thread_safe_method
-    def get_username(self, socket: socket.socket) -> str | None:
+    def get_connected(self, sockets: list[socket.socket]
+                      ) -> list[socket.socket]:
+        return [socket for socket in sockets if socket in self._clients]
+
+    @thread_safe_method
+    def get_usernames(self, exclude: socket.socket | None = None
+                      ) -> list[str]:
+        return [session.username for client, session in self._clients.items()
+                if client != exclude]
+
+    @thread_safe_method
+    def get_session(self, socket: socket.socket) -> ClientSession | None:
         return self._clients.get(socket, None)
 
+    @thread_safe_method
+    def get_username(self, socket: socket.socket) -> str | None:
+        session = self._clients.get(socket, None)
+        return session.username if session is not None else None
+
     @thread_safe_method
     def is_username_taken(self, username: str) -> bool:
-        return username in self._clients.values()
+        return username in self._usernames
 
     @thread_safe_method
     def is_client_connected(self, socket) -> bool:
@@ -49,25 +225,54 @@ class ServerClientHandler:
     DISALLOWED_USERNAMES: list[str] = ["You"]
     MAX_UNAME_LEN: int = 20
     INV_CHARS: str = string.punctuation
-
-    def __init__(self, name: str, clients: Clients) -> None:
+    MAX_ATTACHMENT_BYTES: int = 64 * 1024 * 1024
+    SPOOL_BYTES: int = 64 * 1024
+    # A line longer than this is handled as it is rather than buffered
+    # until its newline arrives.
+    MAX_LINE_BYTES: int = 4096
+    # Logins are announced to everyone else at most this often, so a burst
+    # of N logins costs one broadcast per interval rather than N.
+    JOIN_BATCH_INTERVAL: float = 0.25
+    # The list sent to a new user is cached as ready-made messages of this
+    # many names, shared by every login instead of built for each one.
+    USER_LIST_SEGMENT: int = 1000
+
+    def __init__(self, name: str, clients: Clients,
+                 history: MessageHistory | None = None) -> None:
         self._name: str | None = name
         self.DISALLOWED_USERNAMES.append(self._name)
-        self._message_factory: MessageFactory = MessageFactory(1024)
+        self._message_factory: MessageFactory = MessageFactory(FRAME_BYTES)
         self._clients: Clients = clients
+        self._history: MessageHistory | None = history
         self._running: bool = True
+        self._uploads: dict[socket.socket, Upload] = {}
+        self._transfer_ids: Iterator[int] = itertools.count(1)
+        self._transfers: TransferScheduler = TransferScheduler(
+            self._clients.get_connected, self.writable_clients, self.send_to)
+        self._write: Callable[[socket.socket, bytes], None] = self.write
+        self._writable: Callable[[list[socket.socket], int],
+                                 list[socket.socket]] = self.poll_writable
+        self._release: Callable[[socket.socket], None] = self.release
+        self._joins: list[ClientSession] = []
+        # Held while a client is added or removed and that is announced, so
+        # every client sees joins and leaves in the same order. Reentrant,
+        # since a failed send removes that client too.
+        self._presence_lock = threading.RLock()
+        self._join_timer: threading.Timer | None = None
+        # The user list for send_joins: full segments, then the names that
+        # do not fill one yet. Grown on each login, rebuilt after a leave.
+        self._user_segments: list[bytes] | None = None
+        self._user_tail: list[str] = []
 
     def validate_username(self, client_socket: socket.socket,
                           username: str) -> bool:
         if not username:
-            client_socket.close()
             raise ValueError("Username must be provided")
 
         if len(username) > self.MAX_UNAME_LEN:
             message = self._message_factory.username_too_long(
                 self._name, username, self.MAX_UNAME_LEN)
             self.send_message(client_socket, message)
-            client_socket.close()
             return False
 
         for char in self.INV_CHARS:
@@ -76,113 +281,348 @@ class ServerClientHandler:
                     self._name, username, char
                 )
                 self.send_message(client_socket, message)
-                client_socket.close()
                 return False
 
         if username in self.DISALLOWED_USERNAMES:
             message = self._message_factory.invalid_username(
                 self._name, username)
             self.send_message(client_socket, message)
-            client_socket.close()
             return False
 
         if self._clients.is_username_taken(username):
             message = self._message_factory.username_in_use(
                 self._name, username)
             self.send_message(client_socket, message)
-            client_socket.close()
             return False
 
         return True
 
     def remove_client(self, client_socket) -> None:
+        self._release(client_socket)
         client_socket.close()
-        username = self._clients.get_username(client_socket)
-        self._clients.remove_client(client_socket)
-        message = self._message_factory.leave_meta(username)
-        self.send_all(client_socket, message)
-
-    def add_client(self, client_socket, username: str) -> None:
-        self._clients.add_client(client_socket, username)
+        upload = self._uploads.pop(client_socket, None)
+        if upload is not None and upload.file is not None:
+            upload.file.close()
+        with self._presence_lock:
+            username = self._clients.get_username(client_socket)
+            if username is None:
+                return
+            self._clients.remove_client(client_socket)
+            self._user_segments = None
+            # Nobody may hear of a leave before the join it belongs to.
+            self.flush_joins()
+            message = self._message_factory.leave_meta(username)
+            self.send_all(client_socket, message)
+
+    def add_client(self, session: ClientSession) -> None:
+        with self._presence_lock:
+            self._clients.add_client(session)
+            self.send_joins(session.socket)
+            if not self._clients.is_client_connected(session.socket):
+                return
+            self.extend_user_list(session.username)
+
+            self._joins.append(session)
+            if self._join_timer is None and self._running:
+                self._join_timer = threading.Timer(self.JOIN_BATCH_INTERVAL,
+                                                   self.flush_joins)
+                self._join_timer.daemon = True
+                self._join_timer.start()
+
+    def flush_joins(self) -> None:
+        """
+        Announces the logins since the last flush. Everyone else gets all
+        of them in one message. A new user already got the names of the
+        users before it from send_joins, so it only gets the later ones.
+        """
+        with self._presence_lock:
+            joins, self._joins = self._joins, []
+            if self._join_timer is not None:
+                self._join_timer.cancel()
+                self._join_timer = None
+            if not joins:
+                return
 
-        message = self._message_factory.join_meta(username)
-        self.send_all(client_socket, message)
-        self.send_joins(client_socket)
+            usernames = [session.username for session in joins]
+            joined = {session.socket for session in joins}
+            clients = [client for client in self._clients.get_clients()
+                       if client not in joined]
+            self.send_to(clients, b"".join(self.joins_meta(usernames)))
+            for i, session in enumerate(joins[:-1]):
+                if self._clients.is_client_connected(session.socket):
+                    self.send_message(session.socket,
+                                      self.joins_meta(usernames[i + 1:]))
+
+    def joins_meta(self, usernames: list[str]) -> Iterator[bytes]:
+        if len(usernames) == 1:
+            return self._message_factory.join_meta(usernames[0])
+        return self._message_factory.batch_join_meta(usernames)
+
+    def write(self, client_socket: socket.socket, data: bytes) -> None:
+        # A partial sendall must not let another thread's frames in.
+        session = self._clients.get_session(client_socket)
+        if session is None or session.send_lock is None:
+            client_socket.sendall(data)
+            return
+        with session.send_lock:
+            client_socket.sendall(data)
+
+    def poll_writable(self, clients: list[socket.socket], size: int
+                      ) -> list[socket.socket]:
+        """
+        Returns the clients whose socket is writable right now. Threaded
+        connections block in sendall, so this asks the kernel.
+        """
+        poller = select.poll()
+        for client in clients:
+            try:
+                poller.register(client, select.POLLOUT)
+            except ValueError:
+                # Closed since, it is dropped once it leaves the clients.
+                pass
+        ready = {fd for fd, _ in poller.poll(0)}
+        return [client for client in clients if client.fileno() in ready]
+
+    def writable_clients(self, clients: list[socket.socket], size: int
+                         ) -> list[socket.socket]:
+        return self._writable(clients, size)
+
+    def release(self, client_socket: socket.socket) -> None:
+        """
+        Called just before a client's socket is closed. A thread per
+        connection holds nothing else, so there is nothing to release.
+        """
+
+    def set_transport(self, write: Callable[[socket.socket, bytes], None],
+                      writable: Callable[[list[socket.socket], int],
+                                         list[socket.socket]],
+                      release: Callable[[socket.socket], None]) -> None:
+        self._write = write
+        self._writable = writable
+        self._release = release
 
     def send_message(self, client_socket: socket.socket,
                      message: Iterator[bytes]) -> None:
-        to_remove = None
         try:
-            for chunk in message:
-                client_socket.sendall(chunk)
-                time.sleep(0.01)
+            self._write(client_socket, b"".join(message))
         except socket.error:
-            to_remove = client_socket
-        finally:
-            if not to_remove:
-                return
             self.remove_client(client_socket)
 
+    @profiler.timed
     def send_all(self, client_socket: socket.socket,
                  message: Iterator[bytes]) -> None:
+        # Each client gets the whole message in one write, so its chunks
+        # stay together and cost one call per client.
+        clients = [client for client in self._clients.get_clients()
+                   if client != client_socket]
+        self.send_to(clients, b"".join(message))
+
+    def send_to(self, clients: list[socket.socket], data: bytes) -> None:
         to_remove = []
-        for chunk in message:
-            for client in self._clients.get_clients():
-                if client == client_socket:
-                    continue
-                try:
-                    client.sendall(chunk)
-                except socket.error:
-                    to_remove.append(client)
-            time.sleep(0.01)
+        for client in clients:
+            try:
+                self._write(client, data)
+            except socket.error:
+                to_remove.append(client)
 
         for client in to_remove:
             self.remove_client(client)
 
     def send_joins(self, client_socket: socket.socket) -> None:
-        usernames = []
-        for client in self._clients.get_clients():
-            if client == client_socket:
-                continue
-            username = self._clients.get_username(client)
-            usernames.append(username)
+        if self._user_segments is None:
+            self._user_segments = []
+            self._user_tail = []
+            for username in self._clients.get_usernames(
+                    exclude=client_socket):
+                self.extend_user_list(username)
 
-        if not usernames:
-            return
+        try:
+            for segment in self._user_segments:
+                self._write(client_socket, segment)
+            if self._user_tail:
+                message = self._message_factory.batch_join_meta(
+                    self._user_tail)
+                self._write(client_socket, b"".join(message))
+        except socket.error:
+            self.remove_client(client_socket)
 
-        message = self._message_factory.batch_join_meta(usernames)
-        self.send_message(client_socket, message)
+    def extend_user_list(self, username: str) -> None:
+        self._user_tail.append(username)
+        if len(self._user_tail) == self.USER_LIST_SEGMENT:
+            message = self._message_factory.batch_join_meta(self._user_tail)
+            self._user_segments.append(b"".join(message))
+            self._user_tail = []
 
     def handle_client(self, client_socket: socket.socket, addr) -> None:
         client_socket.settimeout(1.0)
+        session = ClientSession(client_socket, None, addr, threading.Lock())
         try:
-            username = client_socket.recv(1024).decode().strip()
-        except socket.error:
+            while self._running:
+                try:
+                    data = client_socket.recv(1024)
+                    if not data:
+                        break
+                    self.receive(session, data)
+
+                except socket.timeout:
+                    if not self._running:
+                        break
+                except socket.error:
+                    break
+        finally:
+            if session.username is None:
+                client_socket.close()
+            else:
+                self.disconnect(client_socket, addr, session.username)
+
+    def receive(self, session: ClientSession, data: bytes) -> None:
+        """
+        Handles bytes read from a client. Messages end in a newline, except
+        the raw bytes after an "/attach" line, so a read may hold several
+        messages or only part of one. The first message is the username.
+        Raises ConnectionError when the login is refused.
+        """
+        client_socket = session.socket
+        if session.inbox is not None:
+            data = session.inbox + data
+            session.inbox = None
+
+        while data:
+            upload = self._uploads.get(client_socket)
+            if upload is not None:
+                data = self.receive_upload(client_socket, session.username,
+                                           upload, data)
+                continue
+
+            line, newline, rest = data.partition(b"\n")
+            if not newline:
+                if len(data) < self.MAX_LINE_BYTES:
+                    session.inbox = data
+                    return
+                line, rest = (data[:self.MAX_LINE_BYTES],
+                              data[self.MAX_LINE_BYTES:])
+            data = rest
+
+            if session.username is not None:
+                self.handle_message(client_socket, session.addr,
+                                    session.username, line)
+                continue
+            try:
+                logged_in = self.login(
+                    session, line.decode(errors="replace").strip())
+            except ValueError:
+                logged_in = False
+            if not logged_in:
+                raise ConnectionError("Login refused")
+
+    def login(self, session: ClientSession, username: str) -> bool:
+        if not self.validate_username(session.socket, username):
+            return False
+
+        print(f"{username} connected from {session.addr}")
+        session.username = sys.intern(username)
+        self.add_client(session)
+        return True
+
+    @profiler.timed
+    def handle_message(self, client_socket: socket.socket, addr,
+                       username: str, message: bytes) -> None:
+        # Nobody may hear from a user before hearing that it joined.
+        if self._joins:
+            self.flush_joins()
+
+        if (message.startswith(f"{ATTACH_COMMAND} ".encode())
+                and self.begin_upload(client_socket, addr, username,
+                                      message)):
             return
 
-        if not self.validate_username(client_socket, username):
+        # Chat text must never take a handler down, whatever bytes it holds.
+        message = message.decode(errors="replace").strip()
+        if not message:
+            return
+        if (self._history is not None
+                and message.split(" ", 1)[0] == SEARCH_COMMAND):
+            self.search(client_socket, message[len(SEARCH_COMMAND):])
             return
 
-        print(f"{username} connected from {addr}")
-        self.add_client(client_socket, username)
+        print(f"Received from {username}@{addr}: {message}")
+        if self._history is not None:
+            self._history.add(username, message)
+        message = self._message_factory.message(username, message)
+        self.send_all(client_socket, message)
 
-        while self._running:
-            try:
-                message = client_socket.recv(1024)
-                if not message:
-                    break
-                message = message.decode().strip()
-                print(f"Received from {username}@{addr}: {message}")
-                message = self._message_factory.message(username, message)
-                self.send_all(client_socket, message)
+    def search(self, client_socket: socket.socket, text: str) -> None:
+        try:
+            query = SearchQuery.parse(text)
+        except ValueError:
+            message = self._message_factory.invalid_search(self._name,
+                                                           text.strip())
+            self.send_message(client_socket, message)
+            return
+        # Answered later from the history thread, never on the event loop.
+        self._history.search(query, partial(self.send_results, client_socket,
+                                            query.page))
 
-            except socket.timeout:
-                if not self._running:
-                    break
-            except socket.error:
-                break
+    def send_results(self, client_socket: socket.socket, page: int,
+                     total: int, more: bool, results: list[dict]) -> None:
+        if not self._clients.is_client_connected(client_socket):
+            return
+        message = self._message_factory.search_results(results, total, more,
+                                                       page)
+        self.send_message(client_socket, message)
+
+    def begin_upload(self, client_socket: socket.socket, addr,
+                     username: str, message: bytes) -> bool:
+        """
+        Starts receiving the <size> raw bytes that follow an
+        "/attach <size> [name]" line. The payload is spooled to a temporary
+        file as it arrives and is streamed to the other clients once
+        complete. An empty name marks a text paste.
+        """
+        parts = message.decode(errors="replace").split(" ", 2)
+        try:
+            total = int(parts[1])
+        except ValueError:
+            return False
+        if total <= 0:
+            return False
+        name = parts[2] if len(parts) == 3 else ""
+
+        file = None
+        if total > self.MAX_ATTACHMENT_BYTES:
+            message = self._message_factory.attachment_too_large(
+                self._name, total, self.MAX_ATTACHMENT_BYTES)
+            self.send_message(client_socket, message)
+        else:
+            file = tempfile.SpooledTemporaryFile(self.SPOOL_BYTES)
+            print(f"Receiving {total} bytes from {username}@{addr}")
+
+        upload = Upload(next(self._transfer_ids), name, total, file)
+        self._uploads[client_socket] = upload
+        return True
 
-        if client_socket not in self._clients.get_clients():
+    def receive_upload(self, client_socket: socket.socket, username: str,
+                       upload: Upload, data: bytes) -> bytes:
+        piece, leftover = data[:upload.remaining], data[upload.remaining:]
+        upload.remaining -= len(piece)
+        if upload.file is not None:
+            upload.file.write(piece)
+
+        if upload.remaining == 0:
+            self._uploads.pop(client_socket, None)
+            if upload.file is not None:
+                upload.file.seek(0)
+                frames = self._message_factory.stream(
+                    username, upload.transfer_id, upload.file, upload.total,
+                    upload.name)
+                recipients = [client for client in self._clients.get_clients()
+                              if client != client_socket]
+                self._transfers.add(recipients, frames, upload.file)
+        return leftover
+
+    def disconnect(self, client_socket: socket.socket, addr,
+                   username: str) -> None:
+        if not self._clients.is_client_connected(client_socket):
             return
 
         print(f"{username} disconnected from {addr}")
@@ -190,6 +630,14 @@ class ServerClientHandler:
 
     def close_all(self) -> None:
         self._running = False
+        self._transfers.stop()
+        with self._presence_lock:
+            if self._join_timer is not None:
+                self._join_timer.cancel()
+                self._join_timer = None
+            self._joins.clear()
+        if self._history is not None:
+            self._history.close()
         for client in self._clients.get_clients():
             username = self._clients.get_username(client)
             self._clients.remove_client(client)
@@ -200,12 +648,29 @@ class ServerClientHandler:
 
 class ChatServerSocketHandler:
     HOST = "127.0.0.1"
-
-    def __init__(self, client_handler: ServerClientHandler) -> None:
+    # A low-memory client further behind than this is dropped rather than
+    # buffered without bound.
+    MAX_OUTBOX_BYTES: int = 8 * 1024 * 1024
+    # Transfers wait for a client's outbox to drain below this, leaving
+    # the rest of MAX_OUTBOX_BYTES to chat traffic.
+    TRANSFER_OUTBOX_BYTES: int = 64 * 1024
+    COALESCE_BYTES: int = 64 * 1024
+    # Stays under the IOV_MAX of common platforms for sendmsg.
+    COALESCE_PIECES: int = 512
+
+    def __init__(self, client_handler: ServerClientHandler,
+                 low_memory: bool = False) -> None:
         self._socket: socket.socket | None = None
         self._port: str | None = None
         self._running: bool = False
-        self._threads: list[threading.Thread] = []
+        self._low_memory: bool = low_memory
+        self._threads: set[threading.Thread] = set()
+        self._threads_lock = threading.Lock()
+        self._selector: selectors.BaseSelector | None = None
+        self._loop_thread: int | None = None
+        self._wakeup: socket.socket | None = None
+        self._outbox_lock = threading.Lock()
+        self._dirty: set[ClientSession] = set()
         self._client_handler: ServerClientHandler = client_handler
 
     def bind_and_listen(self) -> None:
@@ -214,7 +679,8 @@ class ChatServerSocketHandler:
 
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.bind((ChatServerSocketHandler.HOST, 0))
-        self._socket.listen()
+        # Bursts of logins would overflow the default backlog of 128.
+        self._socket.listen(socket.SOMAXCONN)
 
         self._port = self._socket.getsockname()[-1]
         print(f"Server listening on {self.HOST}:{self._port}")
@@ -227,17 +693,261 @@ class ChatServerSocketHandler:
         while self._running:
             client_socket, addr = self._socket.accept()
             print(f"New connection from {addr}")
-            thread = threading.Thread(target=self._client_handler.handle_client,
+            thread = threading.Thread(target=self.run_client,
                                       args=(client_socket, addr))
+            with self._threads_lock:
+                self._threads.add(thread)
             thread.start()
-            self._threads.append(thread)
+
+    def serve_clients(self) -> None:
+        """
+        Low-memory alternative to accept_clients. Every connection is
+        multiplexed on one selector instead of owning an OS thread, so an
+        idle client only costs its socket and a ClientSession. Sockets are
+        non-blocking; whatever a client cannot take yet waits in its
+        session's outbox until the selector reports it writable.
+        """
+        if not self._socket:
+            raise RuntimeError("Server socket not initialized. "
+                               "Call bind_and_listen first.")
+
+        self._socket.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._socket, selectors.EVENT_READ)
+        # Lets other threads (e.g. the transfer scheduler) wake the loop
+        # when they queue output.
+        wakeup_reader, self._wakeup = socket.socketpair()
+        wakeup_reader.setblocking(False)
+        self._wakeup.setblocking(False)
+        self._selector.register(wakeup_reader, selectors.EVENT_READ)
+        self._loop_thread = threading.get_ident()
+        self._client_handler.set_transport(self.queue_write,
+                                           self.queue_writable,
+                                           self.release_session)
+
+        try:
+            while self._running:
+                for key, events in self._selector.select(timeout=1.0):
+                    if key.fileobj is self._socket:
+                        self.accept_session()
+                    elif key.fileobj is wakeup_reader:
+                        self.drain_wakeup(wakeup_reader)
+                    else:
+                        if events & selectors.EVENT_WRITE:
+                            self.flush_session(key.data)
+                        if events & selectors.EVENT_READ:
+                            self.read_session(key.data)
+                self.flush_dirty()
+        finally:
+            handler = self._client_handler
+            handler.set_transport(handler.write, handler.poll_writable,
+                                  handler.release)
+            self._selector.close()
+            self._selector = None
+            wakeup_reader.close()
+            self._wakeup.close()
+
+    def accept_session(self) -> None:
+        try:
+            client_socket, addr = self._socket.accept()
+        except BlockingIOError:
+            return
+        print(f"New connection from {addr}")
+        client_socket.setblocking(False)
+
+        session = ClientSession(client_socket, None, addr)
+        self._selector.register(client_socket, selectors.EVENT_READ, session)
+
+    def read_session(self, session: ClientSession) -> None:
+        """
+        Reads whatever the client has sent. Under load one read often holds
+        several messages or only part of one, so it is handed to receive(),
+        which buffers it on the session and splits it at newlines.
+        """
+        client_socket = session.socket
+        handler = self._client_handler
+        try:
+            message = client_socket.recv(1024)
+        except BlockingIOError:
+            return
+        except socket.error:
+            message = b""
+
+        try:
+            if not message:
+                raise ConnectionError
+            handler.receive(session, message)
+        except (ConnectionError, ValueError):
+            self.close_session(session)
+
+    def close_session(self, session: ClientSession) -> None:
+        if session.username is None:
+            self.release_session(session.socket)
+            session.socket.close()
+        else:
+            # Releases the session through remove_client.
+            self._client_handler.disconnect(session.socket, session.addr,
+                                            session.username)
+
+    def release_session(self, client_socket: socket.socket) -> None:
+        """
+        Unregisters a socket that is about to be closed and drops anything
+        still queued for it. Every close goes through here, so a closed
+        socket never lingers in the selector.
+        """
+        try:
+            key = self._selector.unregister(client_socket)
+        except (AttributeError, KeyError, ValueError):
+            # Already released, or the selector is shut down.
+            return
+        session = key.data
+        with self._outbox_lock:
+            session.outbox = None
+            session.queued = 0
+            self._dirty.discard(session)
+
+    def queue_write(self, client_socket: socket.socket, data: bytes) -> None:
+        """
+        Writer used in low-memory mode, callable from any thread. Sends
+        whatever the socket takes straight away and queues the rest for
+        the event loop, so a slow client never blocks the server.
+        """
+        try:
+            session = self._selector.get_key(client_socket).data
+        except (AttributeError, KeyError, ValueError):
+            raise ConnectionError("client is not connected")
+
+        with self._outbox_lock:
+            if not session.outbox:
+                try:
+                    sent = client_socket.send(data)
+                except BlockingIOError:
+                    sent = 0
+                if sent == len(data):
+                    return
+                # Broadcasts and user list segments are shared, so keep a
+                # view of the rest rather than a copy per client.
+                data = memoryview(data)[sent:]
+                session.outbox = collections.deque()
+
+            if session.queued + len(data) > self.MAX_OUTBOX_BYTES:
+                raise ConnectionError("client is not reading")
+            session.outbox.append(data)
+            session.queued += len(data)
+            wake = not self._dirty
+            self._dirty.add(session)
+
+        if wake and threading.get_ident() != self._loop_thread:
+            try:
+                self._wakeup.send(b"\0")
+            except (BlockingIOError, OSError):
+                pass
+
+    def queue_writable(self, clients: list[socket.socket], size: int
+                       ) -> list[socket.socket]:
+        """
+        Returns the clients whose outbox can take size more bytes without
+        going over TRANSFER_OUTBOX_BYTES.
+        """
+        ready = []
+        with self._outbox_lock:
+            for client in clients:
+                try:
+                    session = self._selector.get_key(client).data
+                except (AttributeError, KeyError, ValueError):
+                    continue
+                if session.queued + size <= self.TRANSFER_OUTBOX_BYTES:
+                    ready.append(client)
+        return ready
+
+    def drain_wakeup(self, wakeup_reader: socket.socket) -> None:
+        try:
+            while wakeup_reader.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+
+    def flush_dirty(self) -> None:
+        with self._outbox_lock:
+            dirty, self._dirty = self._dirty, set()
+        for session in dirty:
+            self.flush_session(session)
+
+    @staticmethod
+    def send_pieces(client_socket: socket.socket, pieces: list) -> int:
+        if len(pieces) == 1:
+            return client_socket.send(pieces[0])
+        # Gathering the pieces in the kernel spares a copy of the shared
+        # ones (broadcasts, the user list) for every client they go to.
+        if hasattr(client_socket, "sendmsg"):
+            return client_socket.sendmsg(pieces)
+        return client_socket.send(b"".join(pieces))
+
+    def flush_session(self, session: ClientSession) -> None:
+        failed = False
+        with self._outbox_lock:
+            outbox = session.outbox
+            while outbox:
+                # Many small frames (e.g. joins) go out in one send call.
+                pieces = []
+                size = 0
+                while (outbox and size < self.COALESCE_BYTES
+                       and len(pieces) < self.COALESCE_PIECES):
+                    pieces.append(outbox.popleft())
+                    size += len(pieces[-1])
+                try:
+                    sent = self.send_pieces(session.socket, pieces)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    failed = True
+                    break
+                session.queued -= sent
+                if sent < size:
+                    for i, piece in enumerate(pieces):
+                        if sent < len(piece):
+                            break
+                        sent -= len(piece)
+                    rest = pieces[i:]
+                    rest[0] = memoryview(rest[0])[sent:]
+                    outbox.extendleft(reversed(rest))
+                    break
+            if not outbox:
+                session.outbox = None
+            pending = session.outbox is not None
+
+        if failed:
+            self.close_session(session)
+            return
+
+        events = selectors.EVENT_READ
+        if pending:
+            events |= selectors.EVENT_WRITE
+        try:
+            key = self._selector.get_key(session.socket)
+        except (KeyError, ValueError):
+            return
+        if key.events != events:
+            self._selector.modify(session.socket, events, session)
+
+    def run_client(self, client_socket: socket.socket, addr) -> None:
+        try:
+            self._client_handler.handle_client(client_socket, addr)
+        finally:
+            # Drop finished threads straight away instead of keeping every
+            # thread object ever created until shutdown.
+            with self._threads_lock:
+                self._threads.discard(threading.current_thread())
 
     def start(self) -> None:
         if self._running:
             raise RuntimeError("Server already running")
         self._running = True
         self.bind_and_listen()
-        self.accept_clients()
+        if self._low_memory:
+            self.serve_clients()
+        else:
+            self.accept_clients()
 
     def stop(self) -> None:
         if not self._running:
@@ -248,15 +958,20 @@ class ChatServerSocketHandler:
         if self._socket:
             self._socket.close()
 
-        for thread in self._threads:
+        with self._threads_lock:
+            threads = list(self._threads)
+        for thread in threads:
             thread.join()
         print("Server shut down gracefully")
 
 
 def main() -> None:
     clients = Clients()
-    client_handler = ServerClientHandler("SERVER", clients)
-    server = ChatServerSocketHandler(client_handler)
+    history = MessageHistory(os.environ.get("CHAT_HISTORY_DIR", "history"))
+    client_handler = ServerClientHandler("SERVER", clients, history)
+    low_memory = os.environ.get("CHAT_LOW_MEMORY", "") not in ("", "0")
+    server = ChatServerSocketHandler(client_handler, low_memory)
+    profiler.install_signal("server")
 
     try:
         server.start()